@@ -1,12 +1,20 @@
 from lazy import lazy
-from ploy.common import BaseMaster, Executor, StartupScriptMixin
+from ploy.common import BaseMaster, Executor, StartupScriptMixin, shjoin
 from ploy.config import BaseMassager, value_asbool
 from ploy.plain import Instance as PlainInstance
 from ploy.proxy import ProxyInstance
+import argparse
+import contextlib
+import fcntl
+import json
 import logging
+import os
 import re
 import socket
+import struct
+import subprocess
 import sys
+import threading
 import time
 
 
@@ -45,10 +53,56 @@ run_rc_command "$1"
 """
 
 
+rc_startup_detached = """#!/bin/sh
+#
+# BEFORE: DAEMON
+# PROVIDE: ploy.startup_script
+#
+# ploy startup script running in the background
+
+. /etc/rc.subr
+
+name=ploy.startup_script
+start_cmd=startup
+
+startup() {
+
+# Remove traces of ourself
+# N.B.: Do NOT rm $0, it points to /etc/rc
+##########################
+  rm -f "/etc/rc.d/ploy.startup_script"
+
+  test -e /etc/startup_script || return 0
+  (
+    start=$(date +%s)
+    echo "running - $start -" > /var/db/ploy.startup_script
+    /etc/startup_script > /var/log/ploy.startup_script.log 2>&1
+    rc=$?
+    chmod 0600 /etc/startup_script
+    echo "done $rc $start $(date +%s)" > /var/db/ploy.startup_script.tmp
+    mv /var/db/ploy.startup_script.tmp /var/db/ploy.startup_script
+  ) < /dev/null > /dev/null 2>&1 &
+
+}
+
+run_rc_command "$1"
+"""
+
+
+startup_results_script = """for root in "$@"; do
+  if test -e "$root/var/db/ploy.startup_script"; then
+    echo "$root $(cat "$root/var/db/ploy.startup_script")"
+  else
+    echo "$root pending"
+  fi
+done"""
+
+
 class Instance(PlainInstance, StartupScriptMixin):
     sectiongroupname = 'ioc-instance'
 
     _id_regexp = re.compile('^[a-zA-Z0-9_]+$')
+    _zfs_mount_regexp = re.compile(r'^\{zfs\[([^\]]+)\]\}$')
 
     @property
     def _tag(self):
@@ -60,8 +114,67 @@ class Instance(PlainInstance, StartupScriptMixin):
             sys.exit(1)
         return sid
 
+    @property
+    def ip(self):
+        if 'ip' in self.config:
+            return self.config['ip']
+        if 'ip-pool' in self.config:
+            return self.master.addresses.get(self.config_id)
+
     def get_host(self):
-        return self.config.get('host', self.config['ip'])
+        return self.config.get('host', self.ip)
+
+    @property
+    def candidate_masters(self):
+        masters = self.master.ctrl.masters
+        if 'master' in self.config:
+            master_ids = self.config['master'].split()
+        else:
+            master_ids = sorted(
+                x for x in masters if isinstance(masters[x], Master))
+        result = []
+        for master_id in master_ids:
+            if master_id not in masters:
+                log.error("Unknown master '%s' for instance '%s'.", master_id, self.id)
+                sys.exit(1)
+            result.append(masters[master_id])
+        return result
+
+    @property
+    def host_master(self):
+        if not self.config.get('placement'):
+            return self.master
+        master_id = self.master.placements.get(self.config_id)
+        if master_id is None:
+            return self.master
+        masters = self.master.ctrl.masters
+        if master_id not in masters:
+            log.error("Instance '%s' is placed on unknown master '%s'.", self.id, master_id)
+            sys.exit(1)
+        return masters[master_id]
+
+    def place(self):
+        snapshots = collect_load_snapshots(self.candidate_masters)
+        available = [
+            snapshots[x] for x in sorted(snapshots)
+            if snapshots[x] is not None]
+        if not available:
+            log.error("No master available to place instance '%s'.", self.id)
+            sys.exit(1)
+        for snapshot in available:
+            if self._tag in snapshot.jails:
+                master_id = snapshot.master_id
+                log.info("Found existing jail for instance '%s' on master '%s'.", self.id, master_id)
+                break
+        else:
+            name = self.config['placement']
+            policy = find_placement_policies(self.master.ctrl).get(name)
+            if policy is None:
+                log.error("Unknown placement policy '%s' for instance '%s'.", name, self.id)
+                sys.exit(1)
+            master_id = policy(self, available)
+            log.info("Placing instance '%s' on master '%s'.", self.id, master_id)
+        return self.master.ctrl.masters[master_id]
 
     def get_fingerprint(self):
         status = self._status()
@@ -71,7 +184,7 @@ class Instance(PlainInstance, StartupScriptMixin):
         if status != 'running':
             log.info("Instance state: %s", status)
             sys.exit(1)
-        rc, out, err = self.master.iocage_admin('console', tag=self._tag, cmd='ssh-keygen -lf /etc/ssh/ssh_host_rsa_key.pub')
+        rc, out, err = self.host_master.iocage_admin('console', tag=self._tag, cmd='ssh-keygen -lf /etc/ssh/ssh_host_rsa_key.pub')
         info = out.split()
         return info[1]
 
@@ -86,16 +199,17 @@ class Instance(PlainInstance, StartupScriptMixin):
         if status != 'running':
             log.error("Instance state: %s", status)
             raise self.paramiko.SSHException()
+        master = self.host_master
         if 'proxyhost' not in self.config:
-            self.config['proxyhost'] = self.master.id
+            self.config['proxyhost'] = master.id
         if 'proxycommand' not in self.config:
-            mi = self.master.instance
+            mi = master.instance
             self.config['proxycommand'] = self.proxycommand_with_instance(mi)
         return PlainInstance.init_ssh_key(self, user=user)
 
     def _status(self, jails=None):
         if jails is None:
-            jails = self.master.iocage_admin('list')
+            jails = self.host_master.iocage_admin('list')
         if self._tag not in jails:
             return 'unavailable'
         jail = jails[self._tag]
@@ -109,8 +223,9 @@ class Instance(PlainInstance, StartupScriptMixin):
         raise IocageError("Don't know how to handle mounted but not running jail '%s'" % self._tag)
 
     def status(self):
+        master = self.host_master
         try:
-            jails = self.master.iocage_admin('list')
+            jails = master.iocage_admin('list')
         except IocageError as e:
             log.error("Can't get status of jails: %s", e)
             return
@@ -122,55 +237,116 @@ class Instance(PlainInstance, StartupScriptMixin):
             log.info("Instance state: %s", status)
             return
         log.info("Instance running.")
+        if master is not self.master:
+            log.info("Instances master: %s" % master.id)
         log.info("Instances jail id: %s" % jails[self._tag]['jid'])
         if self._tag != self.id:
             log.info("Instances jail tag: %s" % self._tag)
         log.info("Instances jail ip: %s" % jails[self._tag]['ip'])
 
     def start(self, overrides=None):
-        jails = self.master.iocage_admin('list')
+        placed = False
+        if self.config.get('placement') and self.master.placements.get(self.config_id) is None:
+            master = self.place()
+            placed = True
+        else:
+            master = self.host_master
+        jails = master.iocage_admin('list')
         status = self._status(jails)
+        if placed and status != 'unavailable':
+            with self.master.placements.lock():
+                self.master.placements[self.config_id] = master.id
         startup_script = None
         if status == 'unavailable':
             startup_script = self.startup_script(overrides=overrides)
             log.info("Creating instance '%s'", self.id)
-            if 'ip' not in self.config:
+            ip = self.ip
+            if ip is None and 'ip-pool' not in self.config:
                 log.error("No IP address set for instance '%s'", self.id)
                 sys.exit(1)
+            addresses = self.master.addresses
+            allocated = False
+            # concurrent starts must not allocate the same address
+            with addresses.lock():
+                index = build_jail_index(master.ctrl)
+                if self.config.get('placement'):
+                    shared = [master.id]
+                else:
+                    # without placement the instance has its own jail on
+                    # each of its masters
+                    shared = [x.id for x in self.candidate_masters]
+                others = sorted(index.tags.get(self._tag, set()) - set(shared))
+                if others:
+                    log.error(
+                        "Jail tag '%s' of instance '%s' is already used on master %s.",
+                        self._tag, self.id, ', '.join("'%s'" % x for x in others))
+                    sys.exit(1)
+                if ip is None:
+                    pool = self.config['ip-pool']
+                    try:
+                        ip = index.allocate(pool, instance_user(self))
+                    except (IocageError, ValueError, socket.error) as e:
+                        log.error("Can't allocate IP address for instance '%s': %s", self.id, e)
+                        sys.exit(1)
+                    addresses[self.config_id] = ip
+                    self.master.ip_pools[pool] = index.cursors[pool]
+                    allocated = True
+                    log.info("Allocated IP address %s for instance '%s'.", ip, self.id)
+                else:
+                    own = [instance_user(self)]
+                    own.extend(jail_user(x, self._tag) for x in shared)
+                    conflicts = index.conflicts(ip, own=own)
+                    if conflicts:
+                        log.error(
+                            "IP address %s of instance '%s' is already used by %s.",
+                            ip, self.id, ', '.join(conflicts))
+                        sys.exit(1)
             try:
-                self.master.iocage_admin(
+                master.iocage_admin(
                     'create',
                     tag=self._tag,
-                    ip=self.config['ip'],
+                    ip=ip,
                     jailtype=self.config.get('jailtype'))
             except IocageError as e:
                 for line in e.args[0].splitlines():
                     log.error(line)
+                if allocated:
+                    with addresses.lock():
+                        addresses.pop(self.config_id)
                 sys.exit(1)
-            jails = self.master.iocage_admin('list')
+            # only record the placement once the jail exists, so a failed
+            # create is placed again on the next start
+            if placed:
+                with self.master.placements.lock():
+                    self.master.placements[self.config_id] = master.id
+            jails = master.iocage_admin('list')
             jail = jails.get(self._tag)
             startup_dest = '%s/etc/startup_script' % jail['root']
-            rc, out, err = self.master._exec(
+            rc, out, err = master._exec(
                 'sh', '-c', 'cat - > "%s"' % startup_dest,
                 stdin=startup_script)
             if rc != 0:
                 log.error("Startup script creation failed.")
                 log.error(err)
                 sys.exit(1)
-            rc, out, err = self.master._exec("chmod", "0700", startup_dest)
+            rc, out, err = master._exec("chmod", "0700", startup_dest)
             if rc != 0:
                 log.error("Startup script chmod failed.")
                 log.error(err)
                 sys.exit(1)
             rc_startup_dest = '%s/etc/rc.d/ploy.startup_script' % jail['root']
-            rc, out, err = self.master._exec(
+            if self.config.get('startup-detach'):
+                rc_script = rc_startup_detached
+            else:
+                rc_script = rc_startup
+            rc, out, err = master._exec(
                 'sh', '-c', 'cat - > "%s"' % rc_startup_dest,
-                stdin=rc_startup)
+                stdin=rc_script)
             if rc != 0:
                 log.error("Startup rc script creation failed.")
                 log.error(err)
                 sys.exit(1)
-            rc, out, err = self.master._exec("chmod", "0700", rc_startup_dest)
+            rc, out, err = master._exec("chmod", "0700", rc_startup_dest)
             if rc != 0:
                 log.error("Startup rc script chmod failed.")
                 log.error(err)
@@ -184,14 +360,14 @@ class Instance(PlainInstance, StartupScriptMixin):
         mounts = []
         for mount in self.config.get('mounts', []):
             src = mount['src'].format(
-                zfs=self.master.zfs,
+                zfs=master.zfs,
                 tag=self._tag)
             dst = mount['dst'].format(
                 tag=self._tag)
             create_mount = mount.get('create', False)
             mounts.append(dict(src=src, dst=dst, ro=mount.get('ro', False)))
             if create_mount:
-                rc, out, err = self.master._exec("mkdir", "-p", src)
+                rc, out, err = master._exec("mkdir", "-p", src)
                 if rc != 0:
                     log.error("Couldn't create source directory '%s' for mountpoint '%s'." % src, mount['src'])
                     log.error(err)
@@ -201,12 +377,12 @@ class Instance(PlainInstance, StartupScriptMixin):
             jail_fstab = '/etc/fstab.%s' % self._tag
             jail_root = jail['root'].rstrip('/')
             log.info("Setting up mount points")
-            rc, out, err = self.master._exec("head", "-n", "1", jail_fstab)
+            rc, out, err = master._exec("head", "-n", "1", jail_fstab)
             fstab = out.splitlines()
             fstab = fstab[:1]
             fstab.append('# mount points from ploy')
             for mount in mounts:
-                self.master._exec(
+                master._exec(
                     "mkdir", "-p", "%s%s" % (jail_root, mount['dst']))
                 if mount['ro']:
                     mode = 'ro'
@@ -214,21 +390,24 @@ class Instance(PlainInstance, StartupScriptMixin):
                     mode = 'rw'
                 fstab.append('%s %s%s nullfs %s 0 0' % (mount['src'], jail_root, mount['dst'], mode))
             fstab.append('')
-            rc, out, err = self.master._exec(
+            rc, out, err = master._exec(
                 'sh', '-c', 'cat - > "%s"' % jail_fstab,
                 stdin='\n'.join(fstab))
-        if startup_script:
+        detached = startup_script and self.config.get('startup-detach')
+        if startup_script and not detached:
             log.info("Starting instance '%s' with startup script, this can take a while.", self.id)
         else:
             log.info("Starting instance '%s'", self.id)
         try:
-            self.master.iocage_admin(
+            master.iocage_admin(
                 'start',
                 tag=self._tag)
         except IocageError as e:
             for line in e.args[0].splitlines():
                 log.error(line)
             sys.exit(1)
+        if detached:
+            log.info("Startup script of instance '%s' runs in the background, use 'collect' to get the result.", self.id)
 
     def stop(self, overrides=None):
         status = self._status()
@@ -240,11 +419,12 @@ class Instance(PlainInstance, StartupScriptMixin):
             log.info("Instance not stopped")
             return
         log.info("Stopping instance '%s'", self.id)
-        self.master.iocage_admin('stop', tag=self._tag)
+        self.host_master.iocage_admin('stop', tag=self._tag)
         log.info("Instance stopped")
 
     def terminate(self):
-        jails = self.master.iocage_admin('list')
+        master = self.host_master
+        jails = master.iocage_admin('list')
         status = self._status(jails)
         if self.config.get('no-terminate', False):
             log.error("Instance '%s' is configured not to be terminated.", self.id)
@@ -254,20 +434,188 @@ class Instance(PlainInstance, StartupScriptMixin):
             return
         if status == 'running':
             log.info("Stopping instance '%s'", self.id)
-            self.master.iocage_admin('stop', tag=self._tag)
+            master.iocage_admin('stop', tag=self._tag)
         if status != 'stopped':
             log.info('Waiting for jail to stop')
             while status != 'stopped':
-                jails = self.master.iocage_admin('list')
+                jails = master.iocage_admin('list')
                 status = self._status(jails)
                 sys.stdout.write('.')
                 sys.stdout.flush()
                 time.sleep(1)
             print
         log.info("Terminating instance '%s'", self.id)
-        self.master.iocage_admin('destroy', tag=self._tag)
+        master.iocage_admin('destroy', tag=self._tag)
+        if self.config.get('placement'):
+            with self.master.placements.lock():
+                self.master.placements.pop(self.config_id)
+        if 'ip' not in self.config and 'ip-pool' in self.config:
+            with self.master.addresses.lock():
+                self.master.addresses.pop(self.config_id)
         log.info("Instance terminated")
 
+    def _migration_datasets(self, master, root):
+        rc, out, err = master._exec('zfs', 'list', '-H', '-o', 'name', root)
+        if rc != 0:
+            log.error("Couldn't find zfs filesystem of jail '%s'." % self._tag)
+            log.error(err)
+            sys.exit(1)
+        dataset = out.strip()
+        if dataset.endswith('/root'):
+            # iocage keeps the jail properties on the parent of the root
+            dataset = dataset[:-len('/root')]
+        datasets = [dataset]
+        zfs_names = []
+        for mount in self.config.get('mounts', []):
+            match = self._zfs_mount_regexp.match(mount['src'])
+            if match is None:
+                log.warn("Mount source '%s' is no ZFS section and won't be migrated." % mount['src'])
+                continue
+            name = match.group(1)
+            if name in zfs_names:
+                continue
+            zfs_names.append(name)
+            datasets.append(master.zfs[name]['path'])
+        return datasets, zfs_names
+
+    def _migrate_phase(self, source, target, datasets, phase, snapshot, base=None):
+        start = time.time()
+        args = ['zfs', 'snapshot', '-r']
+        args.extend('%s@%s' % (x, snapshot) for x in datasets)
+        rc, out, err = source._exec(*args)
+        if rc != 0:
+            log.error("Couldn't create snapshot '%s'." % snapshot)
+            log.error(err)
+            sys.exit(1)
+        size = 0
+        for dataset in datasets:
+            try:
+                size += source.zfs_send(target, dataset, snapshot, base=base)
+            except IocageError as e:
+                log.error("Transfer of '%s' failed in %s phase." % (dataset, phase))
+                for line in e.args[0].splitlines():
+                    log.error(line)
+                sys.exit(1)
+        log.info(
+            "Migration %s phase: %d bytes in %.1f seconds.",
+            phase, size, time.time() - start)
+        return size
+
+    def _migrate_final(self, source, target, datasets, zfs_names, snapshots, source_root):
+        self._migrate_phase(
+            source, target, datasets, 'final', snapshots[2],
+            base=snapshots[1])
+        rc, out, err = target._exec('zfs', 'mount', '-a')
+        if rc != 0:
+            log.error("Couldn't mount migrated filesystems on master '%s'." % target.id)
+            log.error(err)
+            sys.exit(1)
+        jail = target.iocage_admin('list').get(self._tag)
+        if jail is None:
+            log.error("Migrated jail '%s' not found on master '%s'.", self._tag, target.id)
+            sys.exit(1)
+        jail_fstab = '/etc/fstab.%s' % self._tag
+        rc, out, err = source._exec('cat', jail_fstab)
+        if rc == 0:
+            replacements = [(source_root, jail['root'].rstrip('/'))]
+            for name in zfs_names:
+                replacements.append(
+                    (source.zfs[name].mountpoint, target.zfs[name].mountpoint))
+            fstab = []
+            for line in out.splitlines():
+                fields = line.split()
+                if line.startswith('#') or len(fields) < 2:
+                    fstab.append(line)
+                    continue
+                for i in (0, 1):
+                    for old, new in replacements:
+                        if fields[i] == old or fields[i].startswith(old + '/'):
+                            fields[i] = new + fields[i][len(old):]
+                            break
+                fstab.append(' '.join(fields))
+            fstab.append('')
+            rc, out, err = target._exec(
+                'sh', '-c', 'cat - > "%s"' % jail_fstab,
+                stdin='\n'.join(fstab))
+            if rc != 0:
+                log.error("Couldn't write '%s' on master '%s'." % (jail_fstab, target.id))
+                log.error(err)
+                sys.exit(1)
+        log.info("Starting instance '%s' on master '%s'.", self.id, target.id)
+        try:
+            target.iocage_admin('start', tag=self._tag)
+        except IocageError as e:
+            for line in e.args[0].splitlines():
+                log.error(line)
+            sys.exit(1)
+
+    def migrate(self, target):
+        source = self.host_master
+        if target is source:
+            log.error("Instance '%s' is already on master '%s'.", self.id, target.id)
+            sys.exit(1)
+        jails = source.iocage_admin('list')
+        status = self._status(jails)
+        if status == 'unavailable':
+            log.error("Instance '%s' unavailable", self.id)
+            sys.exit(1)
+        if self._tag in target.iocage_admin('list'):
+            log.error("Jail '%s' already exists on master '%s'.", self._tag, target.id)
+            sys.exit(1)
+        source_root = jails[self._tag]['root'].rstrip('/')
+        datasets, zfs_names = self._migration_datasets(source, source_root)
+        rc, out, err = target._exec('zfs', 'list', '-H', '-o', 'name', *datasets)
+        existing = [x for x in out.splitlines() if x.strip() in datasets]
+        if existing:
+            log.error(
+                "Filesystems already exist on master '%s': %s",
+                target.id, ', '.join(existing))
+            sys.exit(1)
+        log.info("Migrating instance '%s' from master '%s' to '%s'.", self.id, source.id, target.id)
+        start = time.time()
+        prefix = 'ploy-migrate-%d' % start
+        snapshots = ['%s-%d' % (prefix, x) for x in range(3)]
+        self._migrate_phase(source, target, datasets, 'full', snapshots[0])
+        self._migrate_phase(
+            source, target, datasets, 'incremental', snapshots[1],
+            base=snapshots[0])
+        downtime = time.time()
+        if status == 'running':
+            log.info("Stopping instance '%s' on master '%s'.", self.id, source.id)
+            source.iocage_admin('stop', tag=self._tag)
+        try:
+            self._migrate_final(
+                source, target, datasets, zfs_names, snapshots, source_root)
+        except SystemExit:
+            # don't leave the jail stopped on both masters
+            if status == 'running':
+                log.info("Restarting instance '%s' on master '%s'.", self.id, source.id)
+                try:
+                    source.iocage_admin('start', tag=self._tag)
+                except IocageError as e:
+                    for line in e.args[0].splitlines():
+                        log.error(line)
+            log.error(
+                "The received filesystems on master '%s' have to be destroyed before migrating again.",
+                target.id)
+            raise
+        if self.config.get('placement'):
+            with self.master.placements.lock():
+                self.master.placements[self.config_id] = target.id
+        else:
+            log.warn("Change the 'master' option of instance '%s' to '%s'.", self.id, target.id)
+        for dataset in datasets:
+            rc, out, err = target._exec(
+                'zfs', 'destroy', '-r', '%s@%s' % (dataset, ','.join(snapshots)))
+            if rc != 0:
+                log.warn("Couldn't destroy migration snapshots of '%s' on master '%s'.", dataset, target.id)
+                log.warn(err)
+        end = time.time()
+        log.info(
+            "Migration finished in %.1f seconds with %.1f seconds downtime.",
+            end - start, end - downtime)
+        log.info("The jail on master '%s' is stopped and can be destroyed.", source.id)
+
 
 class ZFS_FS(object):
     def __init__(self, zfs, tag, config):
@@ -313,17 +661,446 @@ class ZFS_FS(object):
         return self.mountpoint
 
 
+_zfs_size_regexp = re.compile(r'^(\d+(?:\.\d+)?)([KMGTPE]?)B?$', re.IGNORECASE)
+
+# properties with sizes, ``zfs get -p`` shows them in bytes and ``none`` as 0
+zfs_size_properties = frozenset([
+    'quota', 'recordsize', 'refquota', 'refreservation', 'reservation',
+    'special_small_blocks', 'volblocksize', 'volsize'])
+
+# properties with a fixed set of values which ZFS accepts in any case
+zfs_enum_properties = frozenset([
+    'aclinherit', 'aclmode', 'atime', 'canmount', 'checksum', 'compression',
+    'dedup', 'devices', 'exec', 'jailed', 'logbias', 'primarycache',
+    'readonly', 'redundant_metadata', 'secondarycache', 'setuid', 'snapdir',
+    'sync', 'xattr'])
+
+
+def normalize_zfs_value(prop, value):
+    """ Returns a comparable form of the ``value`` of the ZFS property
+        ``prop``. Sizes like ``16K`` are converted to bytes like
+        ``zfs get -p`` shows them. Other values are compared as they are.
+    """
+    if value is None:
+        return None
+    value = value.strip()
+    if prop in zfs_enum_properties:
+        return value.lower()
+    if prop not in zfs_size_properties:
+        return value
+    if value.lower() == 'none':
+        return '0'
+    match = _zfs_size_regexp.match(value)
+    if match is None:
+        return value
+    number, unit = match.groups()
+    exponent = ' KMGTPE'.index(unit.upper() or ' ')
+    return str(int(float(number) * 1024 ** exponent))
+
+
+class ZFSConfigPaths(object):
+    """ Used instead of ``ZFS`` to format ``path`` options, so references
+        like ``{zfs[data][path]}`` are resolved from the config only,
+        without looking up or creating filesystems on the host.
+    """
+    def __init__(self, config):
+        self.config = config
+
+    def __getitem__(self, key):
+        config = dict(self.config[key])
+        config['path'] = config['path'].format(zfs=self)
+        return config
+
+
 class ZFS(object):
+    # changing these doesn't rewrite existing data
+    new_write_properties = frozenset([
+        'checksum', 'compression', 'copies', 'dedup', 'recordsize'])
+
     def __init__(self, master):
         self.master = master
         self.config = self.master.main_config.get('ioc-zfs', {})
         self._cache = {}
+        self.paths = ZFSConfigPaths(self.config)
 
     def __getitem__(self, key):
         if key not in self._cache:
             self._cache[key] = ZFS_FS(self, key, self.config[key])
         return self._cache[key]
 
+    def drift(self):
+        """ Compares the ``set-*`` options of all ZFS sections with the
+            properties of the filesystems using a single ``zfs get``.
+            Returns a list of ``(path, property, configured, current)`` and
+            a list of the paths whose properties couldn't be fetched.
+        """
+        expected = {}
+        for name in sorted(self.config):
+            properties = dict(
+                (k[4:], v) for k, v in self.config[name].items()
+                if k.startswith('set-'))
+            if properties:
+                path = self.paths[name]['path']
+                expected.setdefault(path, {}).update(properties)
+        if not expected:
+            return [], []
+        properties = sorted(set(
+            x for props in expected.values() for x in props))
+        args = ['zfs', 'get', '-Hp', '-o', 'name,property,value']
+        args.append(','.join(properties))
+        args.extend(sorted(expected))
+        rc, out, err = self.master._exec(*args)
+        current = {}
+        for line in out.splitlines():
+            info = line.split('\t')
+            if len(info) != 3:
+                continue
+            current.setdefault(info[0], {})[info[1]] = info[2]
+        if rc != 0 and err.strip():
+            for line in err.strip().splitlines():
+                log.error(line)
+        result = []
+        failed = []
+        for path in sorted(expected):
+            if path not in current:
+                log.error("Couldn't get properties of zfs filesystem '%s'." % path)
+                failed.append(path)
+                continue
+            for prop, value in sorted(expected[path].items()):
+                value_now = current[path].get(prop)
+                if normalize_zfs_value(prop, value) != normalize_zfs_value(prop, value_now):
+                    result.append((path, prop, value, value_now))
+        return result, failed
+
+    def fix(self, drift):
+        """ Applies the configured values of the ``drift`` entries with one
+            ``zfs set`` per filesystem in a single command on the host.
+        """
+        properties = {}
+        for path, prop, value, value_now in drift:
+            properties.setdefault(path, []).append('%s=%s' % (prop, value))
+        cmds = [
+            ['zfs', 'set'] + properties[path] + [path]
+            for path in sorted(properties)]
+        if len(cmds) == 1:
+            return self.master._exec(*cmds[0])
+        return self.master._exec(
+            'sh', '-c', ' && '.join(shjoin(x) for x in cmds))
+
+    def check(self, fix=False):
+        drift, failed = self.drift()
+        if not drift and not failed:
+            log.info("No drift in ZFS properties on master '%s'.", self.master.id)
+            return drift
+        for path, prop, value, value_now in drift:
+            msg = "%s: %s is '%s', configured '%s'" % (path, prop, value_now, value)
+            if prop in self.new_write_properties:
+                msg = "%s (only affects new writes)" % msg
+            log.warn(msg)
+        if fix and drift:
+            self._fix_drift(drift)
+        if failed:
+            log.error(
+                "Couldn't check %d ZFS filesystems on master '%s'.",
+                len(failed), self.master.id)
+            sys.exit(1)
+        return drift
+
+    def _fix_drift(self, drift):
+        log.info("Setting %d ZFS properties on master '%s'.", len(drift), self.master.id)
+        rc, out, err = self.fix(drift)
+        if rc != 0:
+            log.error("Couldn't set ZFS properties.")
+            log.error(err)
+            sys.exit(1)
+        rewrite = sorted(set(
+            path for path, prop, value, value_now in drift
+            if prop in self.new_write_properties))
+        for path in rewrite:
+            log.warn("Existing data in '%s' keeps the old settings until it is rewritten.", path)
+
+
+class JSONDict(object):
+    """ Mapping which is stored in a JSON file on every change, used to
+        record placements and allocated addresses.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    @contextlib.contextmanager
+    def lock(self):
+        """ Holds an exclusive lock, so a read-modify-write sequence isn't
+            interleaved with other ploy processes. The lock is on a separate
+            file, because writing replaces the data file.
+        """
+        with open('%s.lock' % self.path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield self
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            data = f.read()
+        if not data.strip():
+            return {}
+        return json.loads(data)
+
+    def _write(self, data):
+        # readers don't take the lock, so they must never see a partly
+        # written file
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=4, sort_keys=True)
+        os.rename(tmp, self.path)
+
+    def items(self):
+        return self._read().items()
+
+    def get(self, key, default=None):
+        return self._read().get(key, default)
+
+    def pop(self, key, default=None):
+        data = self._read()
+        value = data.pop(key, default)
+        self._write(data)
+        return value
+
+    def __setitem__(self, key, value):
+        data = self._read()
+        data[key] = value
+        self._write(data)
+
+
+def normalize_ip(ip):
+    """ Strips interface and prefix length, e.g. ``em0|10.0.0.1/24`` becomes
+        ``10.0.0.1``. Returns ``None`` if there is no address.
+    """
+    if ip is None:
+        return None
+    ip = ip.split('|')[-1].split('/')[0].strip()
+    if ip in ('', '-'):
+        return None
+    return ip
+
+
+def ip_to_int(ip):
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+
+def int_to_ip(value):
+    return socket.inet_ntoa(struct.pack('!I', value))
+
+
+class JailIndex(object):
+    """ Index of jail tags and IP addresses of all masters and the config.
+        Users of an address are described by strings, so they can directly
+        be used in messages.
+    """
+    def __init__(self, cursors=None):
+        self.tags = {}
+        self.ips = {}
+        self.cursors = dict(cursors or {})
+
+    def add_jail(self, master_id, tag, ip):
+        self.tags.setdefault(tag, set()).add(master_id)
+        self.add_ip(ip, jail_user(master_id, tag))
+
+    def add_ip(self, ip, user):
+        ip = normalize_ip(ip)
+        if ip is not None:
+            self.ips.setdefault(ip, set()).add(user)
+
+    def conflicts(self, ip, own=()):
+        return sorted(self.ips.get(normalize_ip(ip), set()) - set(own))
+
+    def allocate(self, pool, user):
+        """ Returns the next free address of the ``pool`` in CIDR notation
+            and registers it for ``user``. The search starts at the cursor
+            of the pool, which points behind the last allocated address.
+            When the cursor is persisted, allocating addresses one after
+            the other doesn't rescan the used part of the pool. At the end
+            of the pool the search wraps around to reuse released addresses.
+        """
+        network, prefix = pool.split('/')
+        prefix = int(prefix)
+        if not 0 <= prefix <= 32:
+            raise ValueError("Invalid prefix length in pool '%s'." % pool)
+        mask = (0xffffffff << (32 - prefix)) & 0xffffffff
+        first = ip_to_int(network) & mask
+        last = first | (~mask & 0xffffffff)
+        if prefix < 31:
+            # skip network and broadcast address
+            first = first + 1
+            last = last - 1
+        start = first
+        if pool in self.cursors:
+            start = ip_to_int(self.cursors[pool])
+            if not first <= start <= last:
+                start = first
+        cursor = start
+        while True:
+            ip = int_to_ip(cursor)
+            if cursor < last:
+                cursor = cursor + 1
+            else:
+                cursor = first
+            if ip not in self.ips:
+                self.cursors[pool] = int_to_ip(cursor)
+                self.add_ip(ip, user)
+                return ip
+            if cursor == start:
+                break
+        raise IocageError("No free address left in pool '%s'." % pool)
+
+
+def jail_user(master_id, tag):
+    return "jail '%s' on master '%s'" % (tag, master_id)
+
+
+def instance_user(instance):
+    return "instance '%s'" % instance.config_id
+
+
+def build_jail_index(ctrl):
+    masters = [x for x in ctrl.masters.values() if isinstance(x, Master)]
+    if not masters:
+        return JailIndex()
+    index = JailIndex(cursors=dict(masters[0].ip_pools.items()))
+    lists = run_on_masters(lambda x: x.iocage_admin('list'), masters)
+    for master_id, jails in lists.items():
+        if jails is None:
+            log.warn("Jails of master '%s' are not checked for conflicts.", master_id)
+            continue
+        for tag, jail in jails.items():
+            index.add_jail(master_id, tag, jail.get('ip'))
+    for master in masters:
+        for sid, instance in master.instances.items():
+            if instance is master.instance:
+                continue
+            index.add_ip(instance.config.get('ip'), instance_user(instance))
+    for config_id, ip in masters[0].addresses.items():
+        index.add_ip(ip, "instance '%s'" % config_id)
+    return index
+
+
+class LocalPipe(object):
+    def __init__(self, args):
+        self.proc = subprocess.Popen(
+            args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        self.stdin = self.proc.stdin
+        self.stdout = self.proc.stdout
+
+    def close_stdin(self):
+        self.stdin.close()
+
+    def kill(self):
+        # closing stdout makes the rest of a shell pipeline exit on SIGPIPE
+        self.proc.kill()
+        self.stdout.close()
+
+    def wait(self):
+        err = self.proc.stderr.read()
+        return self.proc.wait(), err
+
+
+class RemotePipe(object):
+    def __init__(self, instance, cmd):
+        log.debug('Piping on instance %s:\n%s', instance.uid, cmd)
+        self.chan = instance.conn.get_transport().open_session()
+        self.stdin = self.chan.makefile('wb', -1)
+        self.stdout = self.chan.makefile('rb', -1)
+        self.stderr = self.chan.makefile_stderr('rb', -1)
+        self.chan.exec_command(cmd)
+
+    def close_stdin(self):
+        self.stdin.flush()
+        self.chan.shutdown_write()
+
+    def kill(self):
+        self.chan.close()
+
+    def wait(self):
+        err = self.stderr.read()
+        rc = self.chan.recv_exit_status()
+        self.chan.close()
+        return rc, err
+
+
+class LoadSnapshot(object):
+    def __init__(self, master_id, jails, mem_free, pool_free, load):
+        self.master_id = master_id
+        self.jails = jails
+        self.mem_free = mem_free
+        self.pool_free = pool_free
+        self.load = load
+
+    def __repr__(self):
+        return "<LoadSnapshot %s jails=%d mem_free=%d pool_free=%d load=%.2f>" % (
+            self.master_id, len(self.jails), self.mem_free, self.pool_free,
+            self.load)
+
+
+def run_on_masters(func, masters):
+    """ Calls ``func`` with each of the ``masters`` concurrently and returns
+        a dict of the results by master id. Failures are logged and map to
+        ``None``.
+    """
+    results = {}
+
+    def run(master):
+        try:
+            results[master.id] = func(master)
+        except (Exception, SystemExit) as e:
+            log.error("Command on master '%s' failed: %s", master.id, e)
+            results[master.id] = None
+
+    threads = [
+        threading.Thread(target=run, args=(master,))
+        for master in masters]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def collect_load_snapshots(masters):
+    """ Fetches the load of all masters concurrently. Masters which can't be
+        reached map to ``None``.
+    """
+    return run_on_masters(lambda x: x.load_snapshot(), masters)
+
+
+def least_jails_policy(instance, snapshots):
+    return min(
+        snapshots,
+        key=lambda x: (len(x.jails), x.load)).master_id
+
+
+def least_loaded_policy(instance, snapshots):
+    return min(
+        snapshots,
+        key=lambda x: (x.load, -x.mem_free)).master_id
+
+
+def most_free_policy(instance, snapshots):
+    return min(
+        snapshots,
+        key=lambda x: (-x.mem_free, -x.pool_free)).master_id
+
+
+def find_placement_policies(ctrl):
+    policies = {}
+    for plugin in ctrl.plugins.values():
+        if 'get_placement_policies' in plugin:
+            policies.update(plugin['get_placement_policies']())
+    return policies
+
 
 class IocageProxyInstance(ProxyInstance):
     def status(self):
@@ -338,13 +1115,12 @@ class IocageProxyInstance(ProxyInstance):
                 log.error("Can't get status of jails: %s", e)
                 return result
             unknown = set(jails)
-            for sid in sorted(self.master.instances):
-                if sid == self.id:
-                    continue
-                instance = self.master.instances[sid]
-                unknown.remove(instance._tag)
+            instances = self.master.hosted_instances
+            for sid in sorted(instances):
+                instance = instances[sid]
+                unknown.discard(instance._tag)
                 status = instance._status(jails)
-                sip = instance.config.get('ip', '')
+                sip = instance.ip or ''
                 jip = jails.get(instance._tag, {}).get('ip', 'unknown ip')
                 if status == 'running' and jip != sip:
                     sip = "%s != configured %s" % (jip, sip)
@@ -362,6 +1138,18 @@ class Master(BaseMaster):
 
     def __init__(self, *args, **kwargs):
         BaseMaster.__init__(self, *args, **kwargs)
+        for sid in list(self.instances):
+            config = self.instances[sid].config
+            if not config.get('placement'):
+                continue
+            # placed instances only live on their first candidate master,
+            # the jail itself is wherever the placement put it
+            if 'master' in config:
+                home = config['master'].split()[0]
+            else:
+                home = sorted(self.main_config.get('ioc-master', {}))[0]
+            if home != self.id:
+                del self.instances[sid]
         self.debug = self.master_config.get('debug-commands', False)
         if 'instance' not in self.master_config:
             instance = PlainInstance(self, self.id, self.master_config)
@@ -376,6 +1164,7 @@ class Master(BaseMaster):
         prefix_args = ()
         if self.master_config.get('sudo'):
             prefix_args = ('sudo',)
+        self.prefix_args = prefix_args
         if self._exec is None:
             self._exec = Executor(
                 instance=self.instance, prefix_args=prefix_args)
@@ -384,6 +1173,143 @@ class Master(BaseMaster):
     def zfs(self):
         return ZFS(self)
 
+    @lazy
+    def placements(self):
+        return JSONDict(os.path.join(self.main_config.path, 'ioc-placements.json'))
+
+    @lazy
+    def addresses(self):
+        return JSONDict(os.path.join(self.main_config.path, 'ioc-addresses.json'))
+
+    @lazy
+    def ip_pools(self):
+        return JSONDict(os.path.join(self.main_config.path, 'ioc-ip-pools.json'))
+
+    @property
+    def hosted_instances(self):
+        result = {}
+        for master in self.ctrl.masters.values():
+            if not isinstance(master, Master):
+                continue
+            for sid, instance in master.instances.items():
+                if instance is master.instance:
+                    continue
+                if instance.host_master is self:
+                    result[sid] = instance
+        return result
+
+    def _pipe(self, *cmd_args):
+        args = self.prefix_args + cmd_args
+        if self.instance is None:
+            return LocalPipe(args)
+        return RemotePipe(self.instance, shjoin(args))
+
+    def zfs_send(self, target, dataset, snapshot, base=None):
+        """ Streams ``dataset@snapshot`` compressed to the same dataset on
+            the ``target`` master, incremental from the ``base`` snapshot if
+            given. Returns the number of transferred bytes.
+        """
+        send = ['zfs', 'send', '-R']
+        if base is not None:
+            send.extend(['-i', '@%s' % base])
+        send.append('%s@%s' % (dataset, snapshot))
+        recv = ['zfs', 'recv', '-u', dataset]
+        if base is not None:
+            # only roll back changes on the target for incremental streams,
+            # a full stream must never replace an existing dataset
+            recv[2:2] = ['-F']
+        source = self._pipe('sh', '-c', '%s | gzip -c' % shjoin(send))
+        dest = target._pipe('sh', '-c', 'gzip -dc | %s' % shjoin(recv))
+        source.close_stdin()
+        size = 0
+        interrupted = False
+        try:
+            while True:
+                data = source.stdout.read(65536)
+                if not data:
+                    break
+                dest.stdin.write(data)
+                size += len(data)
+        except (IOError, OSError, socket.error):
+            # the receiving side died, stop the sender, otherwise it blocks
+            # forever on its full output
+            interrupted = True
+            source.kill()
+        try:
+            dest.close_stdin()
+        except (IOError, OSError, socket.error):
+            interrupted = True
+        src_rc, src_err = source.wait()
+        rc, err = dest.wait()
+        if rc:
+            raise IocageError(err.strip())
+        if interrupted:
+            raise IocageError("Transfer of '%s' was interrupted." % dataset)
+        if src_rc or src_err.strip():
+            raise IocageError(src_err.strip())
+        return size
+
+    def startup_results(self, instances):
+        """ Fetches the state of detached startup scripts of ``instances``
+            with a single command on the host. Returns a dict mapping
+            instance ids to ``(state, rc, seconds)``.
+        """
+        jails = self.iocage_admin('list')
+        results = {}
+        roots = {}
+        for instance in instances:
+            jail = jails.get(instance._tag)
+            if jail is None:
+                results[instance.id] = ('unavailable', None, None)
+                continue
+            roots[jail['root'].rstrip('/')] = instance.id
+        if not roots:
+            return results
+        rc, out, err = self._exec(
+            'sh', '-c', startup_results_script, 'sh', *sorted(roots))
+        if rc:
+            raise IocageError(err.strip())
+        for line in out.splitlines():
+            info = line.split()
+            if not info or info[0] not in roots:
+                continue
+            instance_id = roots[info[0]]
+            if info[1] == 'done' and len(info) == 5:
+                results[instance_id] = (
+                    'done', int(info[2]), int(info[4]) - int(info[3]))
+            else:
+                results[instance_id] = (info[1], None, None)
+        return results
+
+    def load_snapshot(self):
+        jails = self.iocage_admin('list')
+        rc, out, err = self._exec(
+            'sysctl', '-n', 'hw.ncpu', 'hw.pagesize',
+            'vm.stats.vm.v_free_count', 'vm.loadavg')
+        if rc:
+            raise IocageError(err.strip())
+        lines = out.splitlines()
+        if len(lines) != 4:
+            raise IocageError("sysctl output has unexpected format:\n%s" % out.strip())
+        ncpu = int(lines[0])
+        mem_free = int(lines[1]) * int(lines[2])
+        # vm.loadavg looks like '{ 0.15 0.10 0.08 }'
+        loadavg = float(lines[3].strip('{} ').split()[0])
+        rc, out, err = self._exec('zpool', 'list', '-Hp', '-o', 'name,free')
+        if rc:
+            raise IocageError(err.strip())
+        pools = dict(
+            line.split('\t')
+            for line in out.splitlines() if line.strip())
+        if not pools:
+            raise IocageError("No zpools found on master '%s'." % self.id)
+        pool = self.master_config.get('zpool', sorted(pools)[0])
+        if pool not in pools:
+            raise IocageError("Unknown zpool '%s' on master '%s'." % (pool, self.id))
+        return LoadSnapshot(
+            self.id, jails=jails, mem_free=mem_free,
+            pool_free=int(pools[pool]), load=loadavg / ncpu)
+
     @lazy
     def iocage_admin_binary(self):
         binary = self.master_config.get('iocage', '/usr/local/sbin/iocage')
@@ -482,6 +1408,149 @@ class Master(BaseMaster):
             raise ValueError("Unknown command '%s'" % command)
 
 
+class MigrateCmd(object):
+    """Migrate an iocage jail to another master"""
+
+    def __init__(self, ctrl):
+        self.ctrl = ctrl
+
+    def __call__(self, argv, help):
+        parser = argparse.ArgumentParser(
+            prog="%s migrate" % self.ctrl.progname,
+            description=help,
+        )
+        instances = dict(
+            (k, v) for k, v in self.ctrl.instances.items()
+            if isinstance(v, Instance))
+        masters = dict(
+            (k, v) for k, v in self.ctrl.masters.items()
+            if isinstance(v, Master))
+        parser.add_argument("instance", nargs=1,
+                            metavar="instance",
+                            help="Name of the instance from the config.",
+                            choices=sorted(instances))
+        parser.add_argument("master", nargs=1,
+                            metavar="master",
+                            help="Name of the master to migrate to.",
+                            choices=sorted(masters))
+        args = parser.parse_args(argv)
+        instance = instances[args.instance[0]]
+        instance.migrate(masters[args.master[0]])
+
+
+class ZFSCheckCmd(object):
+    """Check ZFS properties against the set-* options of ioc-zfs sections"""
+
+    def __init__(self, ctrl):
+        self.ctrl = ctrl
+
+    def __call__(self, argv, help):
+        parser = argparse.ArgumentParser(
+            prog="%s zfs-check" % self.ctrl.progname,
+            description=help,
+        )
+        masters = dict(
+            (k, v) for k, v in self.ctrl.masters.items()
+            if isinstance(v, Master))
+        parser.add_argument("master", nargs=1,
+                            metavar="master",
+                            help="Name of the master from the config.",
+                            choices=sorted(masters))
+        parser.add_argument("-f", "--fix", dest="fix",
+                            action="store_true",
+                            help="Set the configured values where they differ.")
+        args = parser.parse_args(argv)
+        masters[args.master[0]].zfs.check(fix=args.fix)
+
+
+class CollectCmd(object):
+    """Collect the results of detached startup scripts"""
+
+    def __init__(self, ctrl):
+        self.ctrl = ctrl
+
+    def __call__(self, argv, help):
+        parser = argparse.ArgumentParser(
+            prog="%s collect" % self.ctrl.progname,
+            description=help,
+        )
+        instances = dict(
+            (k, v) for k, v in self.ctrl.instances.items()
+            if isinstance(v, Instance) and v.config.get('startup-detach'))
+        parser.add_argument("instances", nargs="*",
+                            metavar="instance",
+                            help="Name of the instance from the config, defaults to all with startup-detach.")
+        parser.add_argument("-w", "--wait", dest="wait",
+                            action="store_true",
+                            help="Wait until all startup scripts finished.")
+        parser.add_argument("-i", "--interval", dest="interval",
+                            type=int, default=10,
+                            help="Seconds between checks while waiting.")
+        parser.add_argument("-t", "--timeout", dest="timeout",
+                            type=int, default=600,
+                            help="Seconds to wait at most.")
+        args = parser.parse_args(argv)
+        for instance_id in args.instances:
+            if instance_id not in instances:
+                parser.error("invalid instance: '%s' (choose from %s)" % (
+                    instance_id, ', '.join(sorted(instances))))
+        selected = args.instances
+        if not selected:
+            # instances are listed with their uid and their unique short name
+            selected = sorted(
+                k for k, v in instances.items()
+                if k == v.id or instances.get(v.id) is not v)
+        deadline = time.time() + args.timeout
+        timed_out = False
+        while True:
+            by_master = {}
+            for instance_id in selected:
+                instance = instances[instance_id]
+                master = instance.host_master
+                by_master.setdefault(master.id, (master, []))[1].append(
+                    (instance_id, instance))
+            results = {}
+            for master_id in sorted(by_master):
+                master, master_instances = by_master[master_id]
+                try:
+                    master_results = master.startup_results(
+                        [x[1] for x in master_instances])
+                except IocageError as e:
+                    log.error("Can't get startup results on master '%s': %s", master_id, e)
+                    sys.exit(1)
+                for instance_id, instance in master_instances:
+                    results[instance_id] = master_results[instance.id]
+            unfinished = [
+                x for x in selected
+                if results[x][0] in ('pending', 'running')]
+            if not args.wait or not unfinished:
+                break
+            if time.time() >= deadline:
+                log.error("Timed out after %d seconds.", args.timeout)
+                timed_out = True
+                break
+            log.info("Waiting for %d startup scripts.", len(unfinished))
+            time.sleep(min(args.interval, max(deadline - time.time(), 0)))
+        failed = timed_out
+        for instance_id in selected:
+            state, rc, seconds = results[instance_id]
+            if state == 'pending':
+                log.info("%-20s pending, no result in the jail, the startup script didn't start yet or isn't run detached", instance_id)
+            elif state == 'running':
+                log.info("%-20s running, if this doesn't change the jail was probably restarted while the startup script ran", instance_id)
+            elif state != 'done':
+                log.info("%-20s %s", instance_id, state)
+            elif rc == 0:
+                log.info("%-20s succeeded in %d seconds", instance_id, seconds)
+            else:
+                failed = True
+                log.error(
+                    "%-20s failed with exit code %d after %d seconds, see /var/log/ploy.startup_script.log in the jail",
+                    instance_id, rc, seconds)
+        if failed:
+            sys.exit(1)
+
+
 class MountsMassager(BaseMassager):
     def __call__(self, config, sectionname):
         value = BaseMassager.__call__(self, config, sectionname)
@@ -525,6 +1594,7 @@ def get_instance_massagers(sectiongroupname='instance'):
     massagers.extend([
         MountsMassager(sectiongroupname, 'mounts'),
         BooleanMassager(sectiongroupname, 'no-terminate'),
+        BooleanMassager(sectiongroupname, 'startup-detach'),
         StartupScriptMassager(sectiongroupname, 'startup_script')])
     return massagers
 
@@ -557,6 +1627,22 @@ def get_masters(ploy):
         yield Master(ploy, master, master_config)
 
 
+def get_placement_policies():
+    return {
+        'least-jails': least_jails_policy,
+        'least-loaded': least_loaded_policy,
+        'most-free': most_free_policy}
+
+
+def get_commands(ctrl):
+    return [
+        ('collect', CollectCmd(ctrl)),
+        ('migrate', MigrateCmd(ctrl)),
+        ('zfs-check', ZFSCheckCmd(ctrl))]
+
+
 plugin = dict(
+    get_commands=get_commands,
     get_massagers=get_massagers,
-    get_masters=get_masters)
+    get_masters=get_masters,
+    get_placement_policies=get_placement_policies)
@@ -144,20 +144,673 @@ def test_start(ctrl, iocage_tag, master_exec, caplog):
     master_exec.expect = [
         ('/usr/local/sbin/iocage list', 0, iocage_list(), ''),
         ('/usr/local/sbin/iocage list', 0, iocage_list(), ''),
-        ('/usr/local/sbin/iocage create %s 10.0.0.1' % iocage_tag, 0, '', ''),
+        # jail index for conflict checks
+        ('/usr/local/sbin/iocage list', 0, iocage_list(), ''),
+        ("""/usr/local/sbin/iocage create tag=%s 'ip4_addr="10.0.0.1"'""" % iocage_tag, 0, '', ''),
         ('/usr/local/sbin/iocage list', 0, iocage_list({'name': iocage_tag, 'ip': '10.0.0.1', 'status': 'ZS'}), ''),
-        ("""sh -c 'cat - > "/iocage/jails/%s/root/etc/startup_script"'""" % iocage_tag, 0, '', ''),
-        ('chmod 0700 /iocage/jails/%s/root/etc/startup_script' % iocage_tag, 0, '', ''),
-        ("""sh -c 'cat - > "/iocage/jails/%s/root/etc/rc.d/ploy.startup_script"'""" % iocage_tag, 0, '', ''),
-        ('chmod 0700 /iocage/jails/%s/root/etc/rc.d/ploy.startup_script' % iocage_tag, 0, '', ''),
+        ("""sh -c 'cat - > "/iocage/jails/%s/etc/startup_script"'""" % iocage_tag, 0, '', ''),
+        ('chmod 0700 /iocage/jails/%s/etc/startup_script' % iocage_tag, 0, '', ''),
+        ("""sh -c 'cat - > "/iocage/jails/%s/etc/rc.d/ploy.startup_script"'""" % iocage_tag, 0, '', ''),
+        ('chmod 0700 /iocage/jails/%s/etc/rc.d/ploy.startup_script' % iocage_tag, 0, '', ''),
         ('/usr/local/sbin/iocage start %s' % iocage_tag, 0, '', '')]
     ctrl(['./bin/ploy', 'start', 'foo'])
     assert master_exec.expect == []
     assert len(master_exec.got) == 2
-    assert master_exec.got[0][0] == """sh -c 'cat - > "/iocage/jails/%s/root/etc/startup_script"'""" % iocage_tag
+    assert master_exec.got[0][0] == """sh -c 'cat - > "/iocage/jails/%s/etc/startup_script"'""" % iocage_tag
     assert master_exec.got[0][1] == ''
-    assert master_exec.got[1][0] == """sh -c 'cat - > "/iocage/jails/%s/root/etc/rc.d/ploy.startup_script"'""" % iocage_tag
+    assert master_exec.got[1][0] == """sh -c 'cat - > "/iocage/jails/%s/etc/rc.d/ploy.startup_script"'""" % iocage_tag
     assert 'PROVIDE: ploy.startup_script' in master_exec.got[1][1]
     assert caplog_messages(caplog) == [
         "Creating instance 'foo'",
         "Starting instance 'foo'"]
+
+
+@pytest.fixture
+def placement_ctrl(ployconf):
+    from ploy import Controller
+    import ploy_iocage
+    ployconf.fill([
+        '[ioc-master:m1]',
+        '[ioc-master:m2]',
+        '[ioc-instance:foo]',
+        'master = m1 m2',
+        'placement = least-jails',
+        'ip = 10.0.0.1'])
+    ctrl = Controller(configpath=ployconf.directory)
+    ctrl.plugins = {'iocage': ploy_iocage.plugin}
+    ctrl.configfile = ployconf.path
+    return ctrl
+
+
+def test_load_snapshot(placement_ctrl, master_exec):
+    master_exec.expect = [
+        ('/usr/local/sbin/iocage list', 0, iocage_list({'name': 'bar', 'status': 'ZR'}), ''),
+        ('/usr/local/sbin/iocage list', 0, iocage_list({'name': 'bar', 'status': 'ZR'}), ''),
+        ('sysctl -n hw.ncpu hw.pagesize vm.stats.vm.v_free_count vm.loadavg', 0, '4\n4096\n1000\n{ 2.00 1.00 0.50 }\n', ''),
+        ('zpool list -Hp -o name,free', 0, 'tank\t5000\n', '')]
+    snapshot = placement_ctrl.masters['m1'].load_snapshot()
+    assert master_exec.expect == []
+    assert snapshot.master_id == 'm1'
+    assert list(snapshot.jails) == ['bar']
+    assert snapshot.mem_free == 4096000
+    assert snapshot.pool_free == 5000
+    assert snapshot.load == 0.5
+
+
+def test_placement_policies():
+    from ploy_iocage import LoadSnapshot
+    from ploy_iocage import least_jails_policy, least_loaded_policy
+    from ploy_iocage import most_free_policy
+    snapshots = [
+        LoadSnapshot('m1', jails={'a': {}}, mem_free=10, pool_free=5, load=0.1),
+        LoadSnapshot('m2', jails={}, mem_free=5, pool_free=10, load=0.9)]
+    assert least_jails_policy(None, snapshots) == 'm2'
+    assert least_loaded_policy(None, snapshots) == 'm1'
+    assert most_free_policy(None, snapshots) == 'm1'
+
+
+def test_placement_home_master(placement_ctrl):
+    assert 'foo' in placement_ctrl.masters['m1'].instances
+    assert 'foo' not in placement_ctrl.masters['m2'].instances
+    instance = placement_ctrl.instances['foo']
+    assert instance.host_master is placement_ctrl.masters['m1']
+
+
+def test_placement_start(placement_ctrl, master_exec, monkeypatch, caplog):
+    from ploy_iocage import LoadSnapshot
+    import ploy_iocage
+
+    def collect_load_snapshots(masters):
+        assert [x.id for x in masters] == ['m1', 'm2']
+        return dict(
+            m1=LoadSnapshot('m1', jails={'a': {}}, mem_free=1, pool_free=1, load=0),
+            m2=LoadSnapshot('m2', jails={}, mem_free=1, pool_free=1, load=0))
+
+    monkeypatch.setattr(ploy_iocage, 'collect_load_snapshots', collect_load_snapshots)
+    master_exec.expect = [
+        ('/usr/local/sbin/iocage list', 0, iocage_list(), ''),
+        ('/usr/local/sbin/iocage list', 0, iocage_list(), ''),
+        # jail index of both masters
+        ('/usr/local/sbin/iocage list', 0, iocage_list(), ''),
+        ('/usr/local/sbin/iocage list', 0, iocage_list(), ''),
+        ('/usr/local/sbin/iocage list', 0, iocage_list(), ''),
+        ("""/usr/local/sbin/iocage create tag=foo 'ip4_addr="10.0.0.1"'""", 0, '', ''),
+        ('/usr/local/sbin/iocage list', 0, iocage_list({'name': 'foo', 'ip': '10.0.0.1', 'status': 'ZS'}), ''),
+        ("""sh -c 'cat - > "/iocage/jails/foo/etc/startup_script"'""", 0, '', ''),
+        ('chmod 0700 /iocage/jails/foo/etc/startup_script', 0, '', ''),
+        ("""sh -c 'cat - > "/iocage/jails/foo/etc/rc.d/ploy.startup_script"'""", 0, '', ''),
+        ('chmod 0700 /iocage/jails/foo/etc/rc.d/ploy.startup_script', 0, '', ''),
+        ('/usr/local/sbin/iocage start foo', 0, '', '')]
+    placement_ctrl(['./bin/ploy', 'start', 'foo'])
+    assert master_exec.expect == []
+    assert caplog_messages(caplog) == [
+        "Placing instance 'foo' on master 'm2'.",
+        "Creating instance 'foo'",
+        "Starting instance 'foo'"]
+    instance = placement_ctrl.instances['foo']
+    assert instance.host_master is placement_ctrl.masters['m2']
+    assert instance.master.placements.get('ioc-instance:foo') == 'm2'
+
+
+def test_placement_existing_jail(placement_ctrl, master_exec, monkeypatch, caplog):
+    from ploy_iocage import LoadSnapshot
+    import ploy_iocage
+
+    def collect_load_snapshots(masters):
+        return dict(
+            m1=LoadSnapshot('m1', jails={'foo': {}}, mem_free=1, pool_free=1, load=0),
+            m2=LoadSnapshot('m2', jails={}, mem_free=1, pool_free=1, load=0))
+
+    monkeypatch.setattr(ploy_iocage, 'collect_load_snapshots', collect_load_snapshots)
+    master = placement_ctrl.instances['foo'].place()
+    assert master is placement_ctrl.masters['m1']
+    assert caplog_messages(caplog) == [
+        "Found existing jail for instance 'foo' on master 'm1'."]
+
+
+def test_placement_create_failed(placement_ctrl, master_exec, monkeypatch):
+    from ploy_iocage import LoadSnapshot
+    import ploy_iocage
+
+    def collect_load_snapshots(masters):
+        return dict(
+            m1=LoadSnapshot('m1', jails={}, mem_free=1, pool_free=1, load=0),
+            m2=LoadSnapshot('m2', jails={}, mem_free=1, pool_free=1, load=0))
+
+    monkeypatch.setattr(ploy_iocage, 'collect_load_snapshots', collect_load_snapshots)
+    master_exec.expect = [
+        ('/usr/local/sbin/iocage list', 0, iocage_list(), ''),
+        ('/usr/local/sbin/iocage list', 0, iocage_list(), ''),
+        ('/usr/local/sbin/iocage list', 0, iocage_list(), ''),
+        ('/usr/local/sbin/iocage list', 0, iocage_list(), ''),
+        ('/usr/local/sbin/iocage list', 0, iocage_list(), ''),
+        ("""/usr/local/sbin/iocage create tag=foo 'ip4_addr="10.0.0.1"'""", 1, '', 'no space')]
+    with pytest.raises(SystemExit):
+        placement_ctrl(['./bin/ploy', 'start', 'foo'])
+    assert master_exec.expect == []
+    instance = placement_ctrl.instances['foo']
+    assert instance.master.placements.get('ioc-instance:foo') is None
+    assert instance.host_master is placement_ctrl.masters['m1']
+
+
+class FakePipe(object):
+    def __init__(self, out='', rc=0, err=''):
+        self.stdin = StringIO()
+        self.stdout = StringIO(out)
+        self.closed = False
+        self.killed = False
+        self.rc = rc
+        self.err = err
+
+    def close_stdin(self):
+        self.closed = True
+
+    def kill(self):
+        self.killed = True
+
+    def wait(self):
+        return self.rc, self.err
+
+
+class BrokenStdin(object):
+    def write(self, data):
+        raise IOError(32, 'Broken pipe')
+
+
+@pytest.fixture
+def migrate_ctrl(ployconf, monkeypatch):
+    from ploy import Controller
+    from ploy_iocage import Master
+    import ploy_iocage
+    ployconf.fill([
+        '[ioc-master:m1]',
+        '[ioc-master:m2]',
+        '[ioc-zfs:data]',
+        'path = tank/data',
+        '[ioc-instance:foo]',
+        'master = m1 m2',
+        'placement = least-jails',
+        'mounts = src={zfs[data]} dst=/data',
+        'ip = 10.0.0.1'])
+    ctrl = Controller(configpath=ployconf.directory)
+    ctrl.plugins = {'iocage': ploy_iocage.plugin}
+    ctrl.pipes = []
+    # maps send commands to the (rc, err) of a failing sender
+    ctrl.failing_sends = {}
+
+    def _pipe(master, *cmd_args):
+        cmd = shjoin(cmd_args)
+        if cmd_args[-1].startswith('zfs send'):
+            rc, err = ctrl.failing_sends.get(cmd, (0, ''))
+            pipe = FakePipe('x' * 10, rc=rc, err=err)
+        else:
+            pipe = FakePipe()
+        ctrl.pipes.append((master.id, cmd, pipe))
+        return pipe
+
+    monkeypatch.setattr(Master, '_pipe', _pipe)
+    monkeypatch.setattr(ploy_iocage.time, 'time', lambda: 100.0)
+    return ctrl
+
+
+migrate_snapshots = 'tank/iocage/jails/foo@ploy-migrate-100-%d tank/data@ploy-migrate-100-%d'
+
+
+def migrate_expect_until_stop():
+    return [
+        ('/usr/local/sbin/iocage list', 0, iocage_list({'name': 'foo', 'status': 'ZR'}), ''),
+        ('/usr/local/sbin/iocage list', 0, iocage_list({'name': 'foo', 'status': 'ZR'}), ''),
+        ('/usr/local/sbin/iocage list', 0, iocage_list(), ''),
+        ('/usr/local/sbin/iocage list', 0, iocage_list(), ''),
+        ('zfs list -H -o name /iocage/jails/foo', 0, 'tank/iocage/jails/foo/root\n', ''),
+        ('zfs get -Hp -o property,value mountpoint tank/data', 0, 'mountpoint\t/tank/data', ''),
+        ('zfs get -Hp -o property,value mountpoint tank/data', 0, 'mountpoint\t/tank/data', ''),
+        ('zfs list -H -o name tank/iocage/jails/foo tank/data', 1, '', "cannot open 'tank/iocage/jails/foo': dataset does not exist"),
+        ('zfs snapshot -r ' + migrate_snapshots % (0, 0), 0, '', ''),
+        ('zfs snapshot -r ' + migrate_snapshots % (1, 1), 0, '', ''),
+        ('/usr/local/sbin/iocage stop foo', 0, '', ''),
+        ('zfs snapshot -r ' + migrate_snapshots % (2, 2), 0, '', '')]
+
+
+def test_migrate(migrate_ctrl, master_exec, caplog):
+    ctrl = migrate_ctrl
+    pipes = ctrl.pipes
+    master_exec.expect = migrate_expect_until_stop() + [
+        ('zfs mount -a', 0, '', ''),
+        ('/usr/local/sbin/iocage list', 0, iocage_list({'name': 'foo', 'status': 'ZS'}), ''),
+        ('cat /etc/fstab.foo', 0, '/dev/null /foo nullfs ro 0 0\n# mount points from ploy\n/tank/data /iocage/jails/foo/data nullfs rw 0 0\n', ''),
+        ('zfs get -Hp -o property,value mountpoint tank/data', 0, 'mountpoint\t/data', ''),
+        ('zfs get -Hp -o property,value mountpoint tank/data', 0, 'mountpoint\t/data', ''),
+        ("""sh -c 'cat - > "/etc/fstab.foo"'""", 0, '', ''),
+        ('/usr/local/sbin/iocage start foo', 0, '', ''),
+        ('zfs destroy -r tank/iocage/jails/foo@ploy-migrate-100-0,ploy-migrate-100-1,ploy-migrate-100-2', 0, '', ''),
+        ('zfs destroy -r tank/data@ploy-migrate-100-0,ploy-migrate-100-1,ploy-migrate-100-2', 0, '', '')]
+    ctrl(['./bin/ploy', 'migrate', 'foo', 'm2'])
+    assert master_exec.expect == []
+    assert master_exec.got == [(
+        """sh -c 'cat - > "/etc/fstab.foo"'""",
+        '/dev/null /foo nullfs ro 0 0\n# mount points from ploy\n/data /iocage/jails/foo/data nullfs rw 0 0\n')]
+    assert [x[:2] for x in pipes[:4]] == [
+        ('m1', "sh -c 'zfs send -R tank/iocage/jails/foo@ploy-migrate-100-0 | gzip -c'"),
+        ('m2', "sh -c 'gzip -dc | zfs recv -u tank/iocage/jails/foo'"),
+        ('m1', "sh -c 'zfs send -R tank/data@ploy-migrate-100-0 | gzip -c'"),
+        ('m2', "sh -c 'gzip -dc | zfs recv -u tank/data'")]
+    assert pipes[4][1] == "sh -c 'zfs send -R -i @ploy-migrate-100-0 tank/iocage/jails/foo@ploy-migrate-100-1 | gzip -c'"
+    assert pipes[5][1] == "sh -c 'gzip -dc | zfs recv -F -u tank/iocage/jails/foo'"
+    assert len(pipes) == 12
+    assert pipes[1][2].stdin.getvalue() == 'x' * 10
+    assert pipes[1][2].closed
+    assert caplog_messages(caplog) == [
+        "Migrating instance 'foo' from master 'm1' to 'm2'.",
+        "Migration full phase: 20 bytes in 0.0 seconds.",
+        "Migration incremental phase: 20 bytes in 0.0 seconds.",
+        "Stopping instance 'foo' on master 'm1'.",
+        "Migration final phase: 20 bytes in 0.0 seconds.",
+        "Starting instance 'foo' on master 'm2'.",
+        "Migration finished in 0.0 seconds with 0.0 seconds downtime.",
+        "The jail on master 'm1' is stopped and can be destroyed."]
+    assert ctrl.instances['foo'].host_master is ctrl.masters['m2']
+
+
+def test_migrate_final_failed(migrate_ctrl, master_exec, caplog):
+    ctrl = migrate_ctrl
+    send = "sh -c 'zfs send -R -i @ploy-migrate-100-1 tank/iocage/jails/foo@ploy-migrate-100-2 | gzip -c'"
+    ctrl.failing_sends[send] = (1, 'I/O error')
+    master_exec.expect = migrate_expect_until_stop() + [
+        ('/usr/local/sbin/iocage start foo', 0, '', '')]
+    with pytest.raises(SystemExit):
+        ctrl(['./bin/ploy', 'migrate', 'foo', 'm2'])
+    assert master_exec.expect == []
+    assert caplog_messages(caplog)[-5:] == [
+        "Stopping instance 'foo' on master 'm1'.",
+        "Transfer of 'tank/iocage/jails/foo' failed in final phase.",
+        "I/O error",
+        "Restarting instance 'foo' on master 'm1'.",
+        "The received filesystems on master 'm2' have to be destroyed before migrating again."]
+    assert ctrl.instances['foo'].host_master is ctrl.masters['m1']
+
+
+def test_normalize_zfs_value():
+    from ploy_iocage import normalize_zfs_value
+    assert normalize_zfs_value('recordsize', '16K') == '16384'
+    assert normalize_zfs_value('quota', '1M') == '1048576'
+    assert normalize_zfs_value('recordsize', '131072') == '131072'
+    assert normalize_zfs_value('quota', 'none') == '0'
+    assert normalize_zfs_value('compression', 'LZ4') == 'lz4'
+    assert normalize_zfs_value('mountpoint', '/Data') == '/Data'
+    assert normalize_zfs_value('sharenfs', '-maproot=Root') == '-maproot=Root'
+    assert normalize_zfs_value('mountpoint', None) is None
+
+
+def test_zfs_check(ployconf, master_exec, caplog):
+    from ploy import Controller
+    import ploy_iocage
+    ployconf.fill([
+        '[ioc-master:warden]',
+        '[ioc-zfs:data]',
+        'path = tank/data',
+        'create = yes',
+        '[ioc-zfs:db]',
+        'path = {zfs[data][path]}/db',
+        'set-recordsize = 16K',
+        'set-atime = off',
+        '[ioc-zfs:logs]',
+        'path = tank/logs',
+        'set-compression = lz4',
+        'set-quota = none'])
+    ctrl = Controller(configpath=ployconf.directory)
+    ctrl.plugins = {'iocage': ploy_iocage.plugin}
+    master_exec.expect = [
+        ('zfs get -Hp -o name,property,value atime,compression,quota,recordsize tank/data/db tank/logs', 0, '\n'.join([
+            'tank/data/db\tatime\ton',
+            'tank/data/db\trecordsize\t131072',
+            'tank/logs\tcompression\tlz4',
+            'tank/logs\tquota\t0']), ''),
+        ('zfs set atime=off recordsize=16K tank/data/db', 0, '', '')]
+    ctrl(['./bin/ploy', 'zfs-check', '--fix', 'warden'])
+    assert master_exec.expect == []
+    assert caplog_messages(caplog) == [
+        "tank/data/db: atime is 'on', configured 'off'",
+        "tank/data/db: recordsize is '131072', configured '16K' (only affects new writes)",
+        "Setting 2 ZFS properties on master 'warden'.",
+        "Existing data in 'tank/data/db' keeps the old settings until it is rewritten."]
+
+
+def test_zfs_check_failed(ployconf, master_exec, caplog):
+    from ploy import Controller
+    import ploy_iocage
+    ployconf.fill([
+        '[ioc-master:warden]',
+        '[ioc-zfs:db]',
+        'path = tank/db',
+        'set-atime = off',
+        '[ioc-zfs:logs]',
+        'path = tank/logs',
+        'set-compression = lz4'])
+    ctrl = Controller(configpath=ployconf.directory)
+    ctrl.plugins = {'iocage': ploy_iocage.plugin}
+    master_exec.expect = [
+        ('zfs get -Hp -o name,property,value atime,compression tank/db tank/logs', 1, '\n'.join([
+            'tank/db\tatime\ton',
+            'tank/db\tcompression\toff']), "cannot open 'tank/logs': dataset does not exist\n")]
+    with pytest.raises(SystemExit) as e:
+        ctrl(['./bin/ploy', 'zfs-check', 'warden'])
+    assert e.value.code == 1
+    assert master_exec.expect == []
+    assert caplog_messages(caplog) == [
+        "cannot open 'tank/logs': dataset does not exist",
+        "Couldn't get properties of zfs filesystem 'tank/logs'.",
+        "tank/db: atime is 'on', configured 'off'",
+        "Couldn't check 1 ZFS filesystems on master 'warden'."]
+
+
+def test_collect(ployconf, master_exec, caplog):
+    from ploy import Controller
+    from ploy_iocage import startup_results_script
+    import ploy_iocage
+    ployconf.fill([
+        '[ioc-master:warden]',
+        '[ioc-instance:foo]',
+        'ip = 10.0.0.1',
+        'startup-detach = yes',
+        '[ioc-instance:bar]',
+        'ip = 10.0.0.2',
+        'startup-detach = yes',
+        '[ioc-instance:baz]',
+        'ip = 10.0.0.3',
+        'startup-detach = yes',
+        '[ioc-instance:ham]',
+        'ip = 10.0.0.4'])
+    ctrl = Controller(configpath=ployconf.directory)
+    ctrl.plugins = {'iocage': ploy_iocage.plugin}
+    jails = iocage_list(
+        {'name': 'foo', 'status': 'ZR'},
+        {'name': 'bar', 'status': 'ZR'},
+        {'name': 'baz', 'status': 'ZR'})
+    master_exec.expect = [
+        ('/usr/local/sbin/iocage list', 0, jails, ''),
+        ('/usr/local/sbin/iocage list', 0, jails, ''),
+        (shjoin(['sh', '-c', startup_results_script, 'sh', '/iocage/jails/bar', '/iocage/jails/baz', '/iocage/jails/foo']), 0, '\n'.join([
+            '/iocage/jails/bar done 0 100 160',
+            '/iocage/jails/baz running - 100 -',
+            '/iocage/jails/foo done 1 100 105']), '')]
+    with pytest.raises(SystemExit):
+        ctrl(['./bin/ploy', 'collect'])
+    assert master_exec.expect == []
+    assert caplog_messages(caplog) == [
+        "bar                  succeeded in 60 seconds",
+        "baz                  running, if this doesn't change the jail was probably restarted while the startup script ran",
+        "foo                  failed with exit code 1 after 5 seconds, see /var/log/ploy.startup_script.log in the jail"]
+
+
+def test_json_dict(tempdir):
+    from ploy_iocage import JSONDict
+    import os
+    path = os.path.join(tempdir.directory, 'ioc-addresses.json')
+    data = JSONDict(path)
+    assert data.get('foo') is None
+    with data.lock():
+        data['foo'] = '10.0.0.1'
+        data['bar'] = '10.0.0.2'
+    assert data.pop('foo') == '10.0.0.1'
+    assert dict(data.items()) == {'bar': '10.0.0.2'}
+    assert sorted(os.listdir(tempdir.directory)) == [
+        'ioc-addresses.json', 'ioc-addresses.json.lock']
+
+
+def test_jail_index_allocate():
+    from ploy_iocage import IocageError, JailIndex
+    index = JailIndex()
+    index.add_jail('m1', 'foo', 'em0|10.0.1.1/24')
+    index.add_ip('10.0.1.3', "instance 'ioc-instance:bar'")
+    assert index.tags == {'foo': set(['m1'])}
+    assert index.conflicts('10.0.1.1') == ["jail 'foo' on master 'm1'"]
+    assert index.conflicts('10.0.1.1', own=["jail 'foo' on master 'm1'"]) == []
+    assert index.allocate('10.0.1.0/30', 'a') == '10.0.1.2'
+    with pytest.raises(IocageError):
+        index.allocate('10.0.1.0/30', 'b')
+    assert index.conflicts('10.0.1.2') == ['a']
+
+
+def test_jail_index_allocate_cursor():
+    from ploy_iocage import JailIndex
+    index = JailIndex(cursors={'10.0.2.0/29': '10.0.2.5'})
+    index.add_ip('10.0.2.6', 'x')
+    assert index.allocate('10.0.2.0/29', 'a') == '10.0.2.5'
+    assert index.cursors['10.0.2.0/29'] == '10.0.2.6'
+    # 10.0.2.6 is used and .7 is the broadcast address, so it wraps around
+    assert index.allocate('10.0.2.0/29', 'b') == '10.0.2.1'
+    assert index.cursors['10.0.2.0/29'] == '10.0.2.2'
+
+
+def test_start_ip_conflict(ployconf, master_exec, caplog):
+    from ploy import Controller
+    import ploy_iocage
+    ployconf.fill([
+        '[ioc-master:m1]',
+        '[ioc-master:m2]',
+        '[ioc-instance:foo]',
+        'master = m1',
+        'ip = 10.0.0.5'])
+    ctrl = Controller(configpath=ployconf.directory)
+    ctrl.plugins = {'iocage': ploy_iocage.plugin}
+    jails = iocage_list({'name': 'bar', 'status': 'ZR', 'ip': '10.0.0.5'})
+    master_exec.expect = [
+        ('/usr/local/sbin/iocage list', 0, iocage_list(), ''),
+        ('/usr/local/sbin/iocage list', 0, iocage_list(), ''),
+        ('/usr/local/sbin/iocage list', 0, jails, ''),
+        ('/usr/local/sbin/iocage list', 0, jails, ''),
+        ('/usr/local/sbin/iocage list', 0, jails, '')]
+    with pytest.raises(SystemExit):
+        ctrl(['./bin/ploy', 'start', 'foo'])
+    assert master_exec.expect == []
+    messages = caplog_messages(caplog)
+    assert messages[0] == "Creating instance 'foo'"
+    # the order of the concurrent list calls decides which master got 'bar'
+    assert messages[1].startswith(
+        "IP address 10.0.0.5 of instance 'foo' is already used by jail 'bar' on master")
+    assert len(messages) == 2
+
+
+def test_start_ip_pool(ployconf, master_exec, caplog):
+    from ploy import Controller
+    import ploy_iocage
+    ployconf.fill([
+        '[ioc-master:warden]',
+        '[ioc-instance:foo]',
+        'ip-pool = 10.0.0.0/24',
+        '[ioc-instance:bar]',
+        'ip = 10.0.0.2'])
+    ctrl = Controller(configpath=ployconf.directory)
+    ctrl.plugins = {'iocage': ploy_iocage.plugin}
+    master_exec.expect = [
+        ('/usr/local/sbin/iocage list', 0, iocage_list(), ''),
+        ('/usr/local/sbin/iocage list', 0, iocage_list(), ''),
+        ('/usr/local/sbin/iocage list', 0, iocage_list({'name': 'baz', 'status': 'ZR', 'ip': '10.0.0.1'}), ''),
+        ("""/usr/local/sbin/iocage create tag=foo 'ip4_addr="10.0.0.3"'""", 0, '', ''),
+        ('/usr/local/sbin/iocage list', 0, iocage_list({'name': 'foo', 'ip': '10.0.0.3', 'status': 'ZS'}), ''),
+        ("""sh -c 'cat - > "/iocage/jails/foo/etc/startup_script"'""", 0, '', ''),
+        ('chmod 0700 /iocage/jails/foo/etc/startup_script', 0, '', ''),
+        ("""sh -c 'cat - > "/iocage/jails/foo/etc/rc.d/ploy.startup_script"'""", 0, '', ''),
+        ('chmod 0700 /iocage/jails/foo/etc/rc.d/ploy.startup_script', 0, '', ''),
+        ('/usr/local/sbin/iocage start foo', 0, '', '')]
+    ctrl(['./bin/ploy', 'start', 'foo'])
+    assert master_exec.expect == []
+    assert caplog_messages(caplog) == [
+        "Creating instance 'foo'",
+        "Allocated IP address 10.0.0.3 for instance 'foo'.",
+        "Starting instance 'foo'"]
+    instance = ctrl.instances['foo']
+    assert instance.ip == '10.0.0.3'
+    assert instance.get_host() == '10.0.0.3'
+    assert instance.master.ip_pools.get('10.0.0.0/24') == '10.0.0.4'
+
+
+def test_start_ip_pool_create_failed(ployconf, master_exec):
+    from ploy import Controller
+    import ploy_iocage
+    ployconf.fill([
+        '[ioc-master:warden]',
+        '[ioc-instance:foo]',
+        'ip-pool = 10.0.0.0/24'])
+    ctrl = Controller(configpath=ployconf.directory)
+    ctrl.plugins = {'iocage': ploy_iocage.plugin}
+    master_exec.expect = [
+        ('/usr/local/sbin/iocage list', 0, iocage_list(), ''),
+        ('/usr/local/sbin/iocage list', 0, iocage_list(), ''),
+        ('/usr/local/sbin/iocage list', 0, iocage_list(), ''),
+        ("""/usr/local/sbin/iocage create tag=foo 'ip4_addr="10.0.0.1"'""", 1, '', 'failed')]
+    with pytest.raises(SystemExit):
+        ctrl(['./bin/ploy', 'start', 'foo'])
+    assert master_exec.expect == []
+    instance = ctrl.instances['foo']
+    assert instance.master.addresses.get('ioc-instance:foo') is None
+    assert instance.ip is None
+
+
+def test_start_tag_conflict(ployconf, master_exec, caplog):
+    from ploy import Controller
+    import ploy_iocage
+    ployconf.fill([
+        '[ioc-master:m1]',
+        '[ioc-master:m2]',
+        '[ioc-instance:foo]',
+        'master = m1',
+        'ip = 10.0.0.5'])
+    ctrl = Controller(configpath=ployconf.directory)
+    ctrl.plugins = {'iocage': ploy_iocage.plugin}
+    # the index lists of both masters run concurrently, so all contain 'foo'
+    jails = iocage_list({'name': 'foo', 'status': 'ZR', 'ip': '10.0.0.9'})
+    master_exec.expect = [
+        ('/usr/local/sbin/iocage list', 0, iocage_list(), ''),
+        ('/usr/local/sbin/iocage list', 0, iocage_list(), ''),
+        ('/usr/local/sbin/iocage list', 0, jails, ''),
+        ('/usr/local/sbin/iocage list', 0, jails, ''),
+        ('/usr/local/sbin/iocage list', 0, jails, '')]
+    with pytest.raises(SystemExit):
+        ctrl(['./bin/ploy', 'start', 'foo'])
+    assert master_exec.expect == []
+    assert caplog_messages(caplog) == [
+        "Creating instance 'foo'",
+        "Jail tag 'foo' of instance 'foo' is already used on master 'm2'."]
+
+
+def test_start_multi_master(ployconf, master_exec, caplog):
+    from ploy import Controller
+    import ploy_iocage
+    ployconf.fill([
+        '[ioc-master:m1]',
+        '[ioc-master:m2]',
+        '[ioc-instance:foo]',
+        'master = m1 m2',
+        'ip = 10.0.0.5'])
+    ctrl = Controller(configpath=ployconf.directory)
+    ctrl.plugins = {'iocage': ploy_iocage.plugin}
+    # the jail of m1-foo exists, the one of m2-foo may use the same tag and ip
+    jails = iocage_list({'name': 'foo', 'status': 'ZR', 'ip': '10.0.0.5'})
+    master_exec.expect = [
+        ('/usr/local/sbin/iocage list', 0, iocage_list(), ''),
+        ('/usr/local/sbin/iocage list', 0, iocage_list(), ''),
+        ('/usr/local/sbin/iocage list', 0, jails, ''),
+        ('/usr/local/sbin/iocage list', 0, jails, ''),
+        ('/usr/local/sbin/iocage list', 0, jails, ''),
+        ("""/usr/local/sbin/iocage create tag=foo 'ip4_addr="10.0.0.5"'""", 1, '', 'stop here')]
+    with pytest.raises(SystemExit):
+        ctrl(['./bin/ploy', 'start', 'm2-foo'])
+    assert master_exec.expect == []
+    assert caplog_messages(caplog) == [
+        "Creating instance 'foo'",
+        "stop here"]
+
+
+def test_zfs_send_receiver_fails(ployconf, monkeypatch):
+    from ploy import Controller
+    from ploy_iocage import IocageError, Master
+    import ploy_iocage
+    ployconf.fill([
+        '[ioc-master:m1]',
+        '[ioc-master:m2]'])
+    ctrl = Controller(configpath=ployconf.directory)
+    ctrl.plugins = {'iocage': ploy_iocage.plugin}
+    ctrl.configfile = ployconf.path
+    source = FakePipe('x' * 10, rc=-9)
+    dest = FakePipe(rc=1, err='cannot receive: out of space')
+    dest.stdin = BrokenStdin()
+    pipes = [source, dest]
+    monkeypatch.setattr(Master, '_pipe', lambda *a: pipes.pop(0))
+    with pytest.raises(IocageError) as e:
+        ctrl.masters['m1'].zfs_send(ctrl.masters['m2'], 'tank/data', 'snap')
+    assert e.value.args == ('cannot receive: out of space',)
+    assert source.killed
+    assert dest.closed
+
+
+def test_zfs_fix_batches_by_filesystem(ployconf, master_exec):
+    from ploy import Controller
+    import ploy_iocage
+    ployconf.fill(['[ioc-master:warden]'])
+    ctrl = Controller(configpath=ployconf.directory)
+    ctrl.plugins = {'iocage': ploy_iocage.plugin}
+    ctrl.configfile = ployconf.path
+    master_exec.expect = [
+        ("sh -c 'zfs set atime=off recordsize=16K tank/db && zfs set compression=lz4 tank/logs'", 0, '', '')]
+    ctrl.masters['warden'].zfs.fix([
+        ('tank/logs', 'compression', 'lz4', 'off'),
+        ('tank/db', 'atime', 'off', 'on'),
+        ('tank/db', 'recordsize', '16K', '131072')])
+    assert master_exec.expect == []
+
+
+@pytest.fixture
+def collect_ctrl(ployconf, monkeypatch):
+    from ploy import Controller
+    import ploy_iocage
+    ployconf.fill([
+        '[ioc-master:warden]',
+        '[ioc-instance:foo]',
+        'ip = 10.0.0.1',
+        'startup-detach = yes'])
+    ctrl = Controller(configpath=ployconf.directory)
+    ctrl.plugins = {'iocage': ploy_iocage.plugin}
+    clock = [0]
+    monkeypatch.setattr(ploy_iocage.time, 'time', lambda: clock[0])
+
+    def sleep(seconds):
+        clock[0] += seconds
+
+    monkeypatch.setattr(ploy_iocage.time, 'sleep', sleep)
+    return ctrl
+
+
+def collect_expect(*states):
+    from ploy_iocage import startup_results_script
+    jails = iocage_list({'name': 'foo', 'status': 'ZR'})
+    cmd = shjoin(['sh', '-c', startup_results_script, 'sh', '/iocage/jails/foo'])
+    expect = [('/usr/local/sbin/iocage list', 0, jails, '')]
+    for state in states:
+        expect.append(('/usr/local/sbin/iocage list', 0, jails, ''))
+        expect.append((cmd, 0, '/iocage/jails/foo %s' % state, ''))
+    return expect
+
+
+def test_collect_wait(collect_ctrl, master_exec, caplog):
+    master_exec.expect = collect_expect(
+        'pending', 'running - 100 -', 'done 0 100 130')
+    collect_ctrl(['./bin/ploy', 'collect', '--wait', '-i', '5'])
+    assert master_exec.expect == []
+    assert caplog_messages(caplog) == [
+        "Waiting for 1 startup scripts.",
+        "Waiting for 1 startup scripts.",
+        "foo                  succeeded in 30 seconds"]
+
+
+def test_collect_wait_timeout(collect_ctrl, master_exec, caplog):
+    master_exec.expect = collect_expect('pending', 'pending', 'pending')
+    with pytest.raises(SystemExit):
+        collect_ctrl(['./bin/ploy', 'collect', '--wait', '-i', '5', '-t', '8'])
+    assert master_exec.expect == []
+    assert caplog_messages(caplog) == [
+        "Waiting for 1 startup scripts.",
+        "Waiting for 1 startup scripts.",
+        "Timed out after 8 seconds.",
+        "foo                  pending, no result in the jail, the startup script didn't start yet or isn't run detached"]